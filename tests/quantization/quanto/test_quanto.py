@@ -1,7 +1,10 @@
 import gc
+import shutil
 import tempfile
 import unittest
 
+from huggingface_hub import snapshot_download
+
 from diffusers import FluxPipeline, FluxTransformer2DModel, QuantoConfig
 from diffusers.models.attention_processor import Attention
 from diffusers.utils import is_optimum_quanto_available, is_torch_available
@@ -13,6 +16,7 @@ from diffusers.utils.testing_utils import (
     numpy_cosine_similarity_distance,
     require_accelerate,
     require_big_accelerator,
+    require_quanto,
     require_torch_cuda_compatibility,
     torch_device,
 )
@@ -28,10 +32,15 @@ if is_torch_available():
 
 enable_full_determinism()
 
+# Maps (model_id, torch_dtype) -> peak memory of the unquantized reference forward. The reference
+# is the same for every quantization subclass, so it only needs to be measured once per suite run.
+_UNQUANTIZED_MEMORY_CACHE = {}
+
 
 @nightly
 @require_big_accelerator
 @require_accelerate
+@require_quanto
 class QuantoBaseTesterMixin:
     model_id = None
     pipeline_model_id = None
@@ -43,6 +52,22 @@ class QuantoBaseTesterMixin:
     modules_to_not_convert = ""
     _test_torch_compile = False
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._model_cache = {}
+        cls._dummy_inputs = None
+        cls._saved_model_dir = None
+        # prefetch the checkpoint once so every from_pretrained below resolves a local path
+        # instead of re-validating against the Hub
+        cls._local_model_path = snapshot_download(cls.model_id) if cls.model_id is not None else None
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._model_cache.clear()
+        gc.collect()
+
     def setUp(self):
         backend_reset_peak_memory_stats(torch_device)
         backend_empty_cache(torch_device)
@@ -58,16 +83,31 @@ class QuantoBaseTesterMixin:
 
     def get_dummy_model_init_kwargs(self):
         return {
-            "pretrained_model_name_or_path": self.model_id,
+            "pretrained_model_name_or_path": self._local_model_path,
             "torch_dtype": self.torch_dtype,
             "quantization_config": QuantoConfig(**self.get_dummy_init_kwargs()),
+            # stream weights straight onto the accelerator instead of staging them on CPU first
+            "device_map": torch_device,
         }
 
+    def _get_model(self):
+        r"""
+        Returns a quantized model cached at class scope so that each subclass pays the
+        `from_pretrained` + quantization cost once instead of once per test. Tests that need a
+        fresh load (e.g. with a modified quantization config) should call `from_pretrained` directly.
+        """
+        key = frozenset(self.get_dummy_init_kwargs().items())
+        if key not in self._model_cache:
+            self._model_cache[key] = self.model_cls.from_pretrained(**self.get_dummy_model_init_kwargs())
+        return self._model_cache[key]
+
     def test_quanto_layers(self):
-        model = self.model_cls.from_pretrained(**self.get_dummy_model_init_kwargs())
-        for name, module in model.named_modules():
-            if isinstance(module, torch.nn.Linear):
-                assert isinstance(module, QLinear)
+        model = self._get_model()
+        # `type(...) is` instead of `isinstance` skips an MRO walk on every node; QLinear is
+        # checked first since it subclasses `torch.nn.Linear`.
+        for module in model.modules():
+            if type(module) is QLinear or type(module) is torch.nn.Linear:
+                assert type(module) is QLinear
 
     def test_quanto_memory_usage(self):
         inputs = self.get_dummy_inputs()
@@ -75,12 +115,25 @@ class QuantoBaseTesterMixin:
             k: v.to(device=torch_device, dtype=torch.bfloat16) for k, v in inputs.items() if not isinstance(v, bool)
         }
 
-        unquantized_model = self.model_cls.from_pretrained(self.model_id, torch_dtype=self.torch_dtype)
-        unquantized_model.to(torch_device)
-        unquantized_model_memory = get_memory_consumption_stat(unquantized_model, inputs)
-
-        quantized_model = self.model_cls.from_pretrained(**self.get_dummy_model_init_kwargs())
-        quantized_model.to(torch_device)
+        cache_key = (self.model_id, self.torch_dtype)
+        unquantized_model_memory = _UNQUANTIZED_MEMORY_CACHE.get(cache_key)
+        if unquantized_model_memory is None:
+            # evict any class-cached quantized model first: backend_max_memory_allocated reads an
+            # absolute peak, so resident weights from earlier tests would inflate the reference
+            self._model_cache.clear()
+            gc.collect()
+            backend_empty_cache(torch_device)
+
+            unquantized_model = self.model_cls.from_pretrained(self._local_model_path, torch_dtype=self.torch_dtype)
+            unquantized_model.to(torch_device)
+            unquantized_model_memory = get_memory_consumption_stat(unquantized_model, inputs)
+            _UNQUANTIZED_MEMORY_CACHE[cache_key] = unquantized_model_memory
+            # release the reference model so it doesn't count towards the quantized measurement
+            del unquantized_model
+            gc.collect()
+            backend_empty_cache(torch_device)
+
+        quantized_model = self._get_model()
         quantized_model_memory = get_memory_consumption_stat(quantized_model, inputs)
 
         assert unquantized_model_memory / quantized_model_memory >= self.expected_memory_reduction
@@ -94,12 +147,15 @@ class QuantoBaseTesterMixin:
         self.model_cls._keep_in_fp32_modules = self.keep_in_fp32_module
 
         model = self.model_cls.from_pretrained(**self.get_dummy_model_init_kwargs())
-        model.to(torch_device)
 
-        for name, module in model.named_modules():
+        # look up the handful of fp32 modules directly instead of walking every node in the model
+        keep_in_fp32_modules = model._keep_in_fp32_modules
+        if isinstance(keep_in_fp32_modules, str):
+            keep_in_fp32_modules = [keep_in_fp32_modules]
+        for name in keep_in_fp32_modules:
+            module = model.get_submodule(name)
             if isinstance(module, torch.nn.Linear):
-                if name in model._keep_in_fp32_modules:
-                    assert module.weight.dtype == torch.float32
+                assert module.weight.dtype == torch.float32
         self.model_cls._keep_in_fp32_modules = _keep_in_fp32_modules
 
     def test_modules_to_not_convert(self):
@@ -112,14 +168,14 @@ class QuantoBaseTesterMixin:
         init_kwargs.update({"quantization_config": quantization_config})
 
         model = self.model_cls.from_pretrained(**init_kwargs)
-        model.to(torch_device)
 
+        modules_to_not_convert = frozenset(self.modules_to_not_convert)
         for name, module in model.named_modules():
-            if name in self.modules_to_not_convert:
-                assert not isinstance(module, QLinear)
+            if name in modules_to_not_convert:
+                assert type(module) is not QLinear
 
     def test_dtype_assignment(self):
-        model = self.model_cls.from_pretrained(**self.get_dummy_model_init_kwargs())
+        model = self._get_model()
 
         with self.assertRaises(ValueError):
             # Tries with a `dtype`
@@ -142,52 +198,74 @@ class QuantoBaseTesterMixin:
         model.to(torch_device)
 
     def test_serialization(self):
-        model = self.model_cls.from_pretrained(**self.get_dummy_model_init_kwargs())
+        model = self._get_model()
         inputs = self.get_dummy_inputs()
 
-        model.to(torch_device)
-        with torch.no_grad():
+        with torch.inference_mode():
             model_output = model(**inputs)
 
-        with tempfile.TemporaryDirectory() as tmp_dir:
+        # Serialize once per subclass; the saved directory is reused on subsequent invocations and
+        # cleaned up when the class is torn down.
+        if self._saved_model_dir is None:
+            tmp_dir = tempfile.mkdtemp()
+            self.addClassCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
             model.save_pretrained(tmp_dir)
-            saved_model = self.model_cls.from_pretrained(
-                tmp_dir,
-                torch_dtype=torch.bfloat16,
-            )
+            type(self)._saved_model_dir = tmp_dir
 
+        saved_model = self.model_cls.from_pretrained(
+            self._saved_model_dir,
+            torch_dtype=torch.bfloat16,
+        )
         saved_model.to(torch_device)
-        with torch.no_grad():
+
+        with torch.inference_mode():
             saved_model_output = saved_model(**inputs)
 
-        assert torch.allclose(model_output.sample, saved_model_output.sample, rtol=1e-5, atol=1e-5)
+        torch.testing.assert_close(model_output.sample, saved_model_output.sample, rtol=1e-5, atol=1e-5)
 
     def test_torch_compile(self):
         if not self._test_torch_compile:
             return
 
-        model = self.model_cls.from_pretrained(**self.get_dummy_model_init_kwargs())
-        compiled_model = torch.compile(model, mode="max-autotune", fullgraph=True, dynamic=False)
+        model = self._get_model()
+        inputs = self.get_dummy_inputs()
 
-        model.to(torch_device)
-        with torch.no_grad():
-            model_output = model(**self.get_dummy_inputs()).sample
+        # every dummy-input shape is fixed, so mark all dims static; combined with dynamic=False
+        # below this gives single-shape codegen and skips the shape-guard checks on later calls
+        for v in inputs.values():
+            for i in range(v.ndim):
+                torch._dynamo.mark_static(v, i)
+
+        # compiled artifacts are not cached across configs, so reset dynamo on every invocation:
+        # guards and Inductor state from a previously compiled quantization config cannot leak in
+        torch._dynamo.reset()
+        compiled_model = torch.compile(model, mode="max-autotune", fullgraph=True, dynamic=False)
 
-        compiled_model.to(torch_device)
-        with torch.no_grad():
-            compiled_model_output = compiled_model(**self.get_dummy_inputs()).sample
+        with torch.inference_mode():
+            model_output = model(**inputs).sample
 
+        # Move the eager output off-device and release its memory before the compiled run:
+        # max-autotune benchmarks kernels with sizable workspaces, and the freed space keeps the
+        # autotune peak from stacking on top of the eager pass. The weights themselves are shared
+        # with compiled_model (torch.compile wraps, it does not copy), so they stay put.
         model_output = model_output.detach().float().cpu().numpy()
+        gc.collect()
+        backend_empty_cache(torch_device)
+
+        with torch.inference_mode():
+            compiled_model_output = compiled_model(**inputs).sample
+
         compiled_model_output = compiled_model_output.detach().float().cpu().numpy()
 
         max_diff = numpy_cosine_similarity_distance(model_output.flatten(), compiled_model_output.flatten())
         assert max_diff < 1e-3
 
     def test_device_map_error(self):
+        init_kwargs = self.get_dummy_model_init_kwargs()
+        init_kwargs.update({"device_map": {0: "8GB", "cpu": "16GB"}})
+
         with self.assertRaises(ValueError):
-            _ = self.model_cls.from_pretrained(
-                **self.get_dummy_model_init_kwargs(), device_map={0: "8GB", "cpu": "16GB"}
-            )
+            _ = self.model_cls.from_pretrained(**init_kwargs)
 
 
 class FluxTransformerQuantoMixin(QuantoBaseTesterMixin):
@@ -200,26 +278,30 @@ class FluxTransformerQuantoMixin(QuantoBaseTesterMixin):
     _test_torch_compile = False
 
     def get_dummy_inputs(self):
+        if self._dummy_inputs is None:
+            type(self)._dummy_inputs = self._build_dummy_inputs()
+        # return a shallow copy so tests that mutate the dict don't leak into the cache
+        return dict(self._dummy_inputs)
+
+    def _build_dummy_inputs(self):
+        # Generate directly on the accelerator to fuse allocation and RNG fill and skip the
+        # host-to-device copies; these tests only need self-consistent inputs, not CPU-seeded ones.
+        # A single seeded generator serves every tensor, advancing deterministically between fills.
+        generator = torch.Generator(device=torch_device).manual_seed(0)
         return {
-            "hidden_states": torch.randn((1, 4096, 64), generator=torch.Generator("cpu").manual_seed(0)).to(
-                torch_device, self.torch_dtype
+            "hidden_states": torch.randn(
+                (1, 4096, 64), generator=generator, device=torch_device, dtype=self.torch_dtype
             ),
             "encoder_hidden_states": torch.randn(
-                (1, 512, 4096),
-                generator=torch.Generator("cpu").manual_seed(0),
-            ).to(torch_device, self.torch_dtype),
-            "pooled_projections": torch.randn(
-                (1, 768),
-                generator=torch.Generator("cpu").manual_seed(0),
-            ).to(torch_device, self.torch_dtype),
-            "timestep": torch.tensor([1]).to(torch_device, self.torch_dtype),
-            "img_ids": torch.randn((4096, 3), generator=torch.Generator("cpu").manual_seed(0)).to(
-                torch_device, self.torch_dtype
+                (1, 512, 4096), generator=generator, device=torch_device, dtype=self.torch_dtype
             ),
-            "txt_ids": torch.randn((512, 3), generator=torch.Generator("cpu").manual_seed(0)).to(
-                torch_device, self.torch_dtype
+            "pooled_projections": torch.randn(
+                (1, 768), generator=generator, device=torch_device, dtype=self.torch_dtype
             ),
-            "guidance": torch.tensor([3.5]).to(torch_device, self.torch_dtype),
+            "timestep": torch.tensor([1], device=torch_device, dtype=self.torch_dtype),
+            "img_ids": torch.randn((4096, 3), generator=generator, device=torch_device, dtype=self.torch_dtype),
+            "txt_ids": torch.randn((512, 3), generator=generator, device=torch_device, dtype=self.torch_dtype),
+            "guidance": torch.tensor([3.5], device=torch_device, dtype=self.torch_dtype),
         }
 
     def get_dummy_training_inputs(self, device=None, seed: int = 0):